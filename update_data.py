@@ -1,12 +1,21 @@
 import io
 import json
 import gzip
+import os
+import random
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
 
 
 # -----------------------------
@@ -15,7 +24,14 @@ import requests
 DATA_DIR = Path("data")
 LATEST_PATH = DATA_DIR / "latest.json"
 HISTORY_PATH = DATA_DIR / "history.json"
-CLOSES_PATH = DATA_DIR / "closes.csv.gz"   # date,symbol,close
+CLOSES_DIR = DATA_DIR / "closes"   # YYYY-MM-DD.parquet per trading day: date,symbol,close
+LEGACY_CLOSES_CSV = DATA_DIR / "closes.csv.gz"   # old single-file archive, migrated once
+MIGRATED_CLOSES_CSV = DATA_DIR / "closes.csv.gz.migrated"   # kept as a backup, never read
+MAX_CLOSE_DAYS = 1400
+EMA_STATE_PATH = DATA_DIR / "ema_state.json"   # columns: symbol, date, close, ema, n
+
+EMA200_ALPHA = 2.0 / (200 + 1.0)
+MIN_HISTORY = 210
 
 
 # -----------------------------
@@ -27,6 +43,18 @@ BHAV_BASES = [
     "https://archives.nseindia.com/content/historical/EQUITIES",
     "https://www1.nseindia.com/content/historical/EQUITIES",
 ]
+BHAV_COLUMNS = ["SYMBOL", "SERIES", "CLOSE"]   # all we use of ~13 (the day comes from the URL)
+BHAV_CACHE_DIR = DATA_DIR / "bhav_cache"   # downloaded zips, so reruns skip the network
+BHAV_RETRIES = 3   # extra rounds over the mirrors, only for 429 / 5xx
+BHAV_RETRY_SLEEP = 2.0
+BHAV_MAX_RETRY_SLEEP = 30.0   # single wait
+BHAV_RETRY_BUDGET = 60.0   # total retry sleep per get_latest_available_bhavcopy call
+BHAV_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "*/*",
+    "Connection": "keep-alive",
+    "Referer": "https://www.nseindia.com/",
+}
 
 
 def ensure_storage():
@@ -35,9 +63,19 @@ def ensure_storage():
         LATEST_PATH.write_text("{}", encoding="utf-8")
     if not HISTORY_PATH.exists():
         HISTORY_PATH.write_text("[]", encoding="utf-8")
-    if not CLOSES_PATH.exists():
-        df0 = pd.DataFrame(columns=["date", "symbol", "close"])
-        write_closes(df0)
+    if not EMA_STATE_PATH.exists():
+        write_ema_state(empty_ema_state())
+    if not CLOSES_DIR.exists():
+        # Split any single-file archive into day files; rename in only once complete
+        tmp = CLOSES_DIR.with_name(CLOSES_DIR.name + ".tmp")
+        tmp.mkdir(exist_ok=True)
+        legacy = read_legacy_closes()
+        for _, day_df in legacy.groupby("date"):
+            write_closes_day(day_df, directory=tmp)
+        tmp.rename(CLOSES_DIR)
+        # Retire the CSV so a missing closes/ dir can't silently rebuild from stale data
+        if LEGACY_CLOSES_CSV.exists():
+            LEGACY_CLOSES_CSV.rename(MIGRATED_CLOSES_CSV)
 
 
 def read_history():
@@ -47,132 +85,317 @@ def read_history():
         return []
 
 
+def atomic_write(path, data: bytes):
+    # Unchanged content (same-day rerun) is not rewritten, so no spurious commits;
+    # otherwise publish via rename so a reader never sees a half-written file
+    if path.exists() and path.read_bytes() == data:
+        return
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def write_json(path, obj):
+    # Compact separators: machine-read files, no pretty-print cost or whitespace bloat
+    atomic_write(path, json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+
 def write_history(arr):
-    HISTORY_PATH.write_text(json.dumps(arr, indent=2), encoding="utf-8")
+    write_json(HISTORY_PATH, arr)
 
 
 def write_latest(obj):
-    LATEST_PATH.write_text(json.dumps(obj, indent=2), encoding="utf-8")
+    write_json(LATEST_PATH, obj)
+
+
+def empty_ema_state():
+    return pd.DataFrame({
+        "date": pd.Series(dtype=str),
+        "close": pd.Series(dtype=np.float64),
+        "ema": pd.Series(dtype=np.float64),
+        "n": pd.Series(dtype=np.int64),
+    }, index=pd.Index([], dtype=str, name="symbol"))
+
+
+def read_ema_state():
+    # Stored column-wise so it loads straight into arrays; anything unreadable reseeds
+    try:
+        cols = json.loads(EMA_STATE_PATH.read_text(encoding="utf-8"))
+        empty = empty_ema_state()
+        return pd.DataFrame(cols).set_index("symbol")[empty.columns].astype(empty.dtypes.to_dict())
+    except Exception:
+        return empty_ema_state()
+
+
+def write_ema_state(state):
+    write_json(EMA_STATE_PATH, state.reset_index().to_dict(orient="list"))
+
+
+def empty_closes():
+    return pd.DataFrame({
+        "date": pd.Series(dtype="datetime64[ns]"),
+        "symbol": pd.Series(dtype=str),
+        "close": pd.Series(dtype=np.float32),
+    })
+
+
+def closes_day_path(day: str, directory=CLOSES_DIR):
+    return directory / f"{day}.parquet"
 
 
 def read_closes():
-    if not CLOSES_PATH.exists():
-        return pd.DataFrame(columns=["date", "symbol", "close"])
-    with gzip.open(CLOSES_PATH, "rt", encoding="utf-8") as f:
+    files = sorted(CLOSES_DIR.glob("*.parquet"))
+    if not files:
+        return empty_closes()
+    # Parquet keeps dtypes, so no date/number re-parsing on the way in
+    return pq.ParquetDataset(files).read().to_pandas()
+
+
+def write_closes_day(df, directory=CLOSES_DIR):
+    # float32 is plenty for 2-decimal quotes and halves the archive + EMA scan bandwidth
+    out = df.astype({"date": "datetime64[ns]", "close": np.float32})
+    day = out["date"].iloc[0].strftime("%Y-%m-%d")
+    # pyarrow dictionary-encodes the ~500 repeating symbols by default
+    buf = io.BytesIO()
+    out.to_parquet(buf, engine="pyarrow", compression="zstd", index=False)
+    atomic_write(closes_day_path(day, directory), buf.getvalue())
+
+
+def trim_closes(keep=MAX_CLOSE_DAYS):
+    # Day files sort chronologically by name; drop everything before the newest `keep`
+    for f in sorted(CLOSES_DIR.glob("*.parquet"))[:-keep]:
+        f.unlink()
+
+
+def read_legacy_closes():
+    if not LEGACY_CLOSES_CSV.exists():
+        return empty_closes()
+    with gzip.open(LEGACY_CLOSES_CSV, "rt", encoding="utf-8") as f:
         df = pd.read_csv(f)
     if df.empty:
-        return pd.DataFrame(columns=["date", "symbol", "close"])
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
+        return empty_closes()
+    df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d", errors="coerce", cache=True)
     df["symbol"] = df["symbol"].astype(str).str.upper().str.strip()
-    df["close"] = pd.to_numeric(df["close"], errors="coerce")
+    df["close"] = pd.to_numeric(df["close"], errors="coerce", downcast="float")
     df = df.dropna(subset=["date", "symbol", "close"])
     return df
 
 
-def write_closes(df):
-    out = df.copy()
-    if not out.empty:
-        out["date"] = pd.to_datetime(out["date"]).dt.strftime("%Y-%m-%d")
-        out["symbol"] = out["symbol"].astype(str).str.upper().str.strip()
-    with gzip.open(CLOSES_PATH, "wt", encoding="utf-8") as f:
-        out.to_csv(f, index=False)
-
-
 def load_symbols_csv(path="nse500_symbols.csv"):
     df = pd.read_csv(path)
     if "symbol" not in df.columns:
         raise RuntimeError("nse500_symbols.csv must have a header column named: symbol")
     syms = (
         df["symbol"]
+        .dropna()
         .astype(str)
         .str.strip()
         .str.replace("NSE:", "", regex=False)
         .str.replace(".NS", "", regex=False)
         .str.upper()
-        .tolist()
     )
-    seen = set()
-    out = []
-    for s in syms:
-        if not s or s == "NAN":
-            continue
-        if s not in seen:
-            out.append(s)
-            seen.add(s)
+    # pd.unique keeps first-seen order, like the old seen-set loop
+    out = pd.unique(syms[(syms != "") & (syms != "NAN")].to_numpy())
     if len(out) < 100:
         raise RuntimeError(f"Too few symbols in nse500_symbols.csv (found {len(out)}).")
     return out
 
 
+def bhavcopy_filename(dt: datetime):
+    ddmmmyyyy = dt.strftime("%d%b%Y").upper() # 26FEB2026
+    return f"cm{ddmmmyyyy}bhav.csv.zip"
+
+
 def bhavcopy_urls(dt: datetime):
     yyyy = dt.strftime("%Y")
     mmm = dt.strftime("%b").upper()          # FEB
-    ddmmmyyyy = dt.strftime("%d%b%Y").upper() # 26FEB2026
-    fname = f"cm{ddmmmyyyy}bhav.csv.zip"
+    fname = bhavcopy_filename(dt)
     return [f"{base}/{yyyy}/{mmm}/{fname}" for base in BHAV_BASES]
 
 
-def download_bhavcopy(dt: datetime) -> pd.DataFrame:
-    urls = bhavcopy_urls(dt)
+def make_session(pool_size=8):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    # Headers set once here instead of being passed (and merged) on every request
+    session.headers.update(BHAV_HEADERS)
+    return session
 
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Accept": "*/*",
-        "Connection": "keep-alive",
-        "Referer": "https://www.nseindia.com/",
-    }
 
-    last_err = None
-    for url in urls:
+def bhavcopy_maybe_available(session: requests.Session, dt: datetime) -> bool:
+    # Cheap probe: False only when every mirror answers HEAD with 404 (weekend/holiday)
+    if (BHAV_CACHE_DIR / bhavcopy_filename(dt)).exists():
+        return True
+    for url in bhavcopy_urls(dt):
         try:
-            r = requests.get(url, headers=headers, timeout=60, allow_redirects=True)
-            if r.status_code != 200:
-                last_err = RuntimeError(f"{url} (status {r.status_code})")
-                continue
+            r = session.head(url, timeout=10, allow_redirects=True)
+        except Exception:
+            return True
+        if r.status_code != 404:
+            return True
+    return False
+
+
+def retry_wait(r: requests.Response, attempt: int) -> float:
+    # 429/503 honor Retry-After (seconds form); other 5xx back off with jitter
+    retry_after = r.headers.get("Retry-After", "")
+    if r.status_code in (429, 503) and retry_after.isdigit():
+        wait = float(retry_after)
+    else:
+        wait = BHAV_RETRY_SLEEP * 2 ** attempt + random.random()
+    return min(wait, BHAV_MAX_RETRY_SLEEP)
+
+
+def parse_bhavcopy(content: bytes) -> pd.DataFrame:
+    z = zipfile.ZipFile(io.BytesIO(content))
+    name = z.namelist()[0]
+
+    # pyarrow reads just the columns we use; a missing column raises (ArrowKeyError)
+    # and the caller tries the next mirror.
+    # The zip member is streamed in, not extracted to a second in-memory copy.
+    with z.open(name) as fh:
+        tbl = pacsv.read_csv(fh, convert_options=pacsv.ConvertOptions(
+            include_columns=BHAV_COLUMNS,
+            column_types={"CLOSE": pa.string()},
+        ))
+    df = tbl.to_pandas()
+    # Coerce, don't reject: one bad cell (e.g. "-" on a BE row) only loses that row
+    df["CLOSE"] = pd.to_numeric(df["CLOSE"], errors="coerce")
+    return df
 
-            z = zipfile.ZipFile(io.BytesIO(r.content))
-            name = z.namelist()[0]
-            raw = z.read(name)
-            df = pd.read_csv(io.BytesIO(raw))
 
-            df.columns = [c.strip().upper() for c in df.columns]
-            for c in ["SYMBOL", "SERIES", "CLOSE", "TIMESTAMP"]:
-                if c not in df.columns:
-                    raise RuntimeError(f"Bhavcopy missing column {c}. Columns={df.columns.tolist()}")
+def download_bhavcopy(session: requests.Session, dt: datetime, budget=None) -> pd.DataFrame:
+    # budget = {"sleep": seconds}: retry sleep left, shared across the whole lookback
+    cached = BHAV_CACHE_DIR / bhavcopy_filename(dt)
+    if cached.exists():
+        try:
+            return parse_bhavcopy(cached.read_bytes())
+        except Exception:
+            # Damaged cache entry: drop it and fetch the day from the mirrors
+            cached.unlink(missing_ok=True)
+
+    if budget is None:
+        budget = {"sleep": BHAV_RETRY_BUDGET}
 
-            df["TIMESTAMP"] = pd.to_datetime(df["TIMESTAMP"], errors="coerce")
-            df = df.dropna(subset=["TIMESTAMP"])
-            return df
+    last_err = None
+    urls = bhavcopy_urls(dt)
+    for attempt in range(BHAV_RETRIES + 1):
+        # Every mirror once per round; only those answering 429/5xx get another round
+        retry = []
+        wait = 0.0
+        for url in urls:
+            try:
+                r = session.get(url, timeout=60, allow_redirects=True)
+                if r.status_code != 200:
+                    last_err = RuntimeError(f"{url} (status {r.status_code})")
+                    if r.status_code == 429 or r.status_code >= 500:
+                        retry.append(url)
+                        wait = max(wait, retry_wait(r, attempt))
+                    r.close()
+                    continue
+
+                df = parse_bhavcopy(r.content)
+                BHAV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                atomic_write(cached, r.content)
+                prune_bhav_cache()
+                return df
+
+            except Exception as e:
+                last_err = e
+                continue
 
-        except Exception as e:
-            last_err = e
-            continue
+        if not retry or attempt == BHAV_RETRIES or wait > budget["sleep"]:
+            break
+        budget["sleep"] -= wait
+        time.sleep(wait)
+        urls = retry
 
     raise RuntimeError(f"Bhavcopy not available on any mirror for {dt.date()}. Last error: {last_err}")
 
 
-def get_latest_available_bhavcopy(max_lookback_days=30):
+def prune_bhav_cache(keep=10):
+    files = sorted(BHAV_CACHE_DIR.glob("*.zip"), key=lambda f: f.stat().st_mtime)
+    for f in files[:-keep]:
+        f.unlink()
+
+
+def get_latest_available_bhavcopy(max_lookback_days=30, workers=8):
     today = datetime.now()
+    days = [today - timedelta(days=i) for i in range(max_lookback_days)]
     last_err = None
-    for i in range(max_lookback_days):
-        dt = today - timedelta(days=i)
-        try:
-            df = download_bhavcopy(dt)
-            return dt, df
-        except Exception as e:
-            last_err = e
-            continue
+    budget = {"sleep": BHAV_RETRY_BUDGET}
+    with make_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as ex:
+        # HEAD-probe a window of days at once, then download only the newest candidate
+        for start in range(0, len(days), workers):
+            window = days[start:start + workers]
+            found = list(ex.map(lambda dt: bhavcopy_maybe_available(session, dt), window))
+            for dt, ok in zip(window, found):
+                if not ok:
+                    continue
+                try:
+                    return dt, download_bhavcopy(session, dt, budget)
+                except Exception as e:
+                    last_err = e
+                    continue
     raise RuntimeError(f"Could not find any bhavcopy in last lookback window. Last error: {last_err}")
 
 
+def ema_last(close: np.ndarray, span: int, has=None) -> np.ndarray:
+    # Final EMA (adjust=False) of every column of a (dates x symbols) close matrix.
+    # NaN cells (not listed yet / no print that day) carry the previous EMA forward,
+    # so the last state is each symbol's EMA at its most recent close.
+    # Closes may be float32; the EMA state is float64 so 1400 steps don't drift.
+    # `has` is the ~isnan(close) mask, if the caller already built it.
+    if has is None:
+        has = ~np.isnan(close)
+    alpha = 2.0 / (span + 1.0)
+    ema = np.full(close.shape[1], np.nan)
+    unseeded = np.empty(close.shape[1], dtype=bool)
+    diff = np.empty(close.shape[1])
+    for row, row_has in zip(close, has):
+        # Seed first closes, then ema += alpha * (close - ema) where there is a close;
+        # all in place on preallocated buffers (no per-step temporaries)
+        np.isnan(ema, out=unseeded)
+        np.copyto(ema, row, where=unseeded)
+        np.subtract(row, ema, out=diff)
+        diff *= alpha
+        np.add(ema, diff, out=ema, where=row_has)
+    return ema
+
+
 def compute_ema_flags(closes_df: pd.DataFrame):
-    df = closes_df.sort_values(["symbol", "date"]).copy()
-    df["ema200"] = df.groupby("symbol")["close"].transform(
-        lambda s: s.ewm(span=200, adjust=False).mean()
-    )
-    latest = df.groupby("symbol").tail(1).copy()
-    latest["above200"] = latest["close"] > latest["ema200"]
-    return latest[["date", "symbol", "close", "ema200", "above200"]]
+    # (dates x symbols) close matrix; scatter via factorize codes is much cheaper than pivot
+    d_codes, dates = pd.factorize(closes_df["date"], sort=True)
+    s_codes, symbols = pd.factorize(closes_df["symbol"], sort=True)
+    close = np.full((len(dates), len(symbols)), np.nan, dtype=np.float32)
+    close[d_codes, s_codes] = closes_df["close"].to_numpy(dtype=np.float32)
+    has = ~np.isnan(close)
+    ema200 = ema_last(close, span=200, has=has)
+
+    # Row of each symbol's most recent close
+    last = close.shape[0] - 1 - np.argmax(has[::-1], axis=0)
+    cols = np.arange(close.shape[1])
+
+    return pd.DataFrame({
+        "date": np.asarray(dates)[last],
+        "symbol": np.asarray(symbols),
+        "close": close[last, cols],
+        "ema200": ema200,
+        "n": has.sum(axis=0),
+    })
+
+
+def seed_ema_state(closes_df: pd.DataFrame):
+    # Full EMA200 recompute from the closes archive, only for symbols without state
+    if closes_df.empty:
+        return empty_ema_state()
+    flags = compute_ema_flags(closes_df)
+    return pd.DataFrame({
+        "date": flags["date"].dt.strftime("%Y-%m-%d").to_numpy(),
+        "close": flags["close"].to_numpy(dtype=np.float64).round(2),
+        "ema": flags["ema200"].to_numpy(dtype=np.float64),
+        "n": flags["n"].to_numpy(dtype=np.int64),
+    }, index=pd.Index(flags["symbol"].to_numpy(), name="symbol"))
 
 
 def main():
@@ -181,65 +404,74 @@ def main():
 
     # 1) Latest available bhavcopy (covers weekends/holidays)
     dt, bhav = get_latest_available_bhavcopy(max_lookback_days=30)
-    bhav_date = pd.to_datetime(dt.strftime("%Y-%m-%d"))
+    bhav_date = pd.Timestamp(dt.date())
 
     # 2) Filter EQ + your universe
-    bhav["SERIES"] = bhav["SERIES"].astype(str).str.upper()
+    series = bhav["SERIES"].astype(str).str.upper()
     bhav["SYMBOL"] = bhav["SYMBOL"].astype(str).str.upper().str.strip()
 
-    eq = bhav[bhav["SERIES"] == "EQ"].copy()
-    eq = eq[eq["SYMBOL"].isin(symbols)].copy()
-    eq["CLOSE"] = pd.to_numeric(eq["CLOSE"], errors="coerce")
-    eq = eq.dropna(subset=["CLOSE"])
+    # One combined mask and one selection of the two columns used, no intermediate copies
+    keep = (series == "EQ") & bhav["SYMBOL"].isin(symbols) & bhav["CLOSE"].notna()
+    eq = bhav.loc[keep, ["SYMBOL", "CLOSE"]]
 
     if eq.empty:
         raise RuntimeError("Bhavcopy loaded, but no matching EQ symbols found (check symbol list).")
 
-    # 3) Append closes (store only 5y-ish)
-    closes = read_closes()
-
-    already = False
-    if not closes.empty:
-        already = (closes["date"].dt.strftime("%Y-%m-%d") == bhav_date.strftime("%Y-%m-%d")).any()
-
-    if not already:
+    # 3) Archive the day's closes as one file (store only 5y-ish)
+    day = bhav_date.strftime("%Y-%m-%d")
+    if not closes_day_path(day).exists():
         new_rows = pd.DataFrame({
-            "date": [bhav_date] * len(eq),
-            "symbol": eq["SYMBOL"].tolist(),
-            "close": eq["CLOSE"].tolist(),
+            "date": bhav_date,
+            "symbol": eq["SYMBOL"].to_numpy(),
+            "close": eq["CLOSE"].to_numpy(dtype=np.float64),
         })
-        closes = pd.concat([closes, new_rows], ignore_index=True)
-        closes = closes.sort_values(["symbol", "date"])
-        closes = closes.groupby("symbol").tail(1400).reset_index(drop=True)
-        write_closes(closes)
-
-    # 4) Market Health = % stocks above EMA200 (needs enough history)
-    counts = closes.groupby("symbol").size()
-    eligible = counts[counts >= 210].index.tolist()
-    closes_eligible = closes[closes["symbol"].isin(eligible)].copy()
-
-    if closes_eligible.empty:
+        write_closes_day(new_rows)
+        trim_closes()
+
+    # 4) Roll EMA200 forward one close per symbol (seed from closes archive if missing)
+    state = read_ema_state()
+    today = pd.Series(eq["CLOSE"].to_numpy(dtype=np.float64), index=eq["SYMBOL"].to_numpy())
+    cur = state.reindex(today.index)
+
+    roll = today.index[(cur["n"] >= 1) & (cur["date"] < day)]
+    if len(roll):
+        close = today[roll]
+        state.loc[roll, "ema"] = state.loc[roll, "ema"] * (1.0 - EMA200_ALPHA) + close * EMA200_ALPHA
+        state.loc[roll, "close"] = close
+        state.loc[roll, "date"] = day
+        state.loc[roll, "n"] += 1
+
+    seed = today.index[~(cur["n"] >= 1)]
+    if len(seed):
+        closes = read_closes()
+        seeded = seed_ema_state(closes[closes["symbol"].isin(seed)])
+        state = pd.concat([state.drop(seeded.index, errors="ignore"), seeded])
+    write_ema_state(state)
+
+    # 5) Market Health = % stocks above EMA200 (needs enough history)
+    eligible = state[state["n"] >= MIN_HISTORY]
+
+    if eligible.empty:
         raise RuntimeError(
             "Not enough history to compute EMA200 yet. "
             "Next step is one-time backfill of ~5y history (I can give that script)."
         )
 
-    latest_flags = compute_ema_flags(closes_eligible)
-    latest_date = latest_flags["date"].max()
-    today_slice = latest_flags[latest_flags["date"] == latest_date]
+    latest_date = eligible["date"].max()
+    today_slice = eligible[eligible["date"] == latest_date]
 
     total = int(today_slice.shape[0])
-    above = int(today_slice["above200"].sum())
+    above = int((today_slice["close"] > today_slice["ema"]).sum())
     health_pct = round((above / total) * 100, 2) if total else 0.0
 
     latest_obj = {
-        "date": pd.to_datetime(latest_date).strftime("%Y-%m-%d"),
+        "date": latest_date,
         "above200": above,
         "total": total,
         "health_pct": health_pct,
     }
 
-    # 5) Update latest + history
+    # 6) Update latest + history
     hist = read_history()
     last_date = hist[-1]["date"] if hist else None
     if last_date != latest_obj["date"]: